@@ -2,8 +2,11 @@
 import os
 import sys
 import time
-import requests
+import orjson
 from pathlib import Path
+from urllib.parse import urlencode
+
+from http_client import SESSION
 
 
 def get_credentials():
@@ -31,6 +34,8 @@ def validate_story_file(filename: str) -> Path:
 
 
 def get_github_image_url(filename: str) -> str:
+    # The Graph API only accepts image stories by public URL (direct
+    # uploads are limited to video), so the image is served from GitHub
     # Get repository info from environment (set by GitHub Actions)
     repo = os.getenv("GITHUB_REPOSITORY", "melisbackkk/sarajevosmogsquad-")  # format: owner/repo
     branch = os.getenv("GITHUB_REF_NAME", "main")  # default to main
@@ -47,46 +52,101 @@ def sanitize_error_message(message: str, access_token: str) -> str:
     return message.replace(access_token, "***REDACTED***")
 
 
-def post_story_to_instagram(image_url: str, access_token: str, user_id: str) -> str:
-    # Create story container
-    container_url = f"https://graph.facebook.com/v21.0/{user_id}/media"
-    container_payload = {
-        "image_url": image_url,
-        "media_type": "STORIES",
+def wait_for_container(container_id: str, access_token: str, timeout: float = 10.0, interval: float = 0.3):
+    status_url = f"https://graph.facebook.com/v21.0/{container_id}"
+    params = {
+        "fields": "status_code",
+        "access_token": access_token,
+    }
+
+    deadline = time.monotonic() + timeout
+    while True:
+        response = SESSION.get(status_url, params=params)
+
+        if response.status_code != 200:
+            safe_message = sanitize_error_message(response.text, access_token)
+            print(f"Error: {response.status_code} - {safe_message}")
+            response.raise_for_status()
+
+        status = orjson.loads(response.content).get("status_code")
+        if status == "FINISHED":
+            return
+        if status in ("ERROR", "EXPIRED"):
+            raise RuntimeError(f"Container {container_id} failed with status {status}")
+        if time.monotonic() >= deadline:
+            # Let the publish call report whatever is still wrong
+            print(f"Container still {status} after {timeout:.0f}s, publishing anyway")
+            return
+
+        time.sleep(interval)
+
+
+def publish_container(container_id: str, access_token: str, user_id: str) -> str:
+    publish_url = f"https://graph.facebook.com/v21.0/{user_id}/media_publish"
+    publish_payload = {
+        "creation_id": container_id,
         "access_token": access_token,
     }
     
-    print("Creating story container...")
-    response = requests.post(container_url, data=container_payload)
+    print("Publishing story...")
+    response = SESSION.post(publish_url, data=publish_payload)
     
     if response.status_code != 200:
         safe_message = sanitize_error_message(response.text, access_token)
         print(f"Error: {response.status_code} - {safe_message}")
         response.raise_for_status()
     
-    container_id = response.json().get("id")
-    print(f"Container created: {container_id}")
-    
-    # Wait for Instagram to process
-    print("Waiting for Instagram to process...")
-    time.sleep(3)
-    
-    # Publish story
-    publish_url = f"https://graph.facebook.com/v21.0/{user_id}/media_publish"
-    publish_payload = {
-        "creation_id": container_id,
+    return orjson.loads(response.content).get("id")
+
+
+def post_story_to_instagram(image_url: str, access_token: str, user_id: str) -> str:
+    # Create the container and publish it in a single batch request; the
+    # publish step picks up the container id through JSONPath chaining
+    batch = [
+        {
+            "method": "POST",
+            "name": "create",
+            "relative_url": f"{user_id}/media",
+            "body": urlencode({"image_url": image_url, "media_type": "STORIES"}),
+            "omit_response_on_success": False,
+        },
+        {
+            "method": "POST",
+            "relative_url": f"{user_id}/media_publish",
+            "body": "creation_id={result=create:$.id}",
+        },
+    ]
+    batch_payload = {
+        "batch": orjson.dumps(batch).decode(),
         "access_token": access_token,
     }
     
-    print("Publishing story...")
-    response = requests.post(publish_url, data=publish_payload)
+    print("Creating and publishing story...")
+    response = SESSION.post("https://graph.facebook.com/v21.0/", data=batch_payload)
     
     if response.status_code != 200:
         safe_message = sanitize_error_message(response.text, access_token)
         print(f"Error: {response.status_code} - {safe_message}")
         response.raise_for_status()
     
-    media_id = response.json().get("id")
+    create_result, publish_result = orjson.loads(response.content)
+    
+    if not create_result or create_result.get("code") != 200:
+        body = create_result.get("body", "") if create_result else ""
+        safe_message = sanitize_error_message(body, access_token)
+        raise RuntimeError(f"Could not create story container: {safe_message}")
+    
+    container_id = orjson.loads(create_result["body"]).get("id")
+    print(f"Container created: {container_id}")
+    
+    if publish_result and publish_result.get("code") == 200:
+        media_id = orjson.loads(publish_result["body"]).get("id")
+    else:
+        # Usually the container was still processing when the publish ran
+        print("Batched publish did not go through, waiting for Instagram to process...")
+        wait_for_container(container_id, access_token)
+        media_id = publish_container(container_id, access_token, user_id)
+    
     print(f"Story published: {media_id}")
     
     return media_id